@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+"""Benchmarks of slug.py and slug_watch on a synthetic tree of repositories
+
+The script creates in a work directory:
+  server/packages/*.git - bare package repositories
+  server/Refs.git       - Refs repository with heads file describing them
+  heads.big             - large synthetic heads file for parsing benchmarks
+and points slug.py to them with file:// URLs (or a local git daemon with
+--git-daemon). Then it times parsing of refs data, GitRepo.check_remote
+with loose and packed refs, fetch_packages with nothing to fetch and with a
+changed subset of repositories, and slug_watch processing of notification
+files.
+
+Results are printed and can be saved with -o as JSON and compared with an
+earlier run with --compare.
+"""
+
+from argparse import ArgumentParser
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLUG = os.path.join(TOPDIR, 'slug.py')
+SLUG_WATCH = os.path.join(TOPDIR, 'slug_watch')
+EMPTYSHA1 = '0' * 40
+
+
+def git(*args, cwd=None, env=None, stdin=None):
+    proc = subprocess.run(('git',) + args, cwd=cwd, env=env, input=stdin,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return proc.stdout.decode('utf-8').strip()
+
+def timeit(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def reponame(i):
+    return 'pkg{:05d}'.format(i)
+
+def branchname(i):
+    return 'master' if i == 0 else 'branch{}'.format(i)
+
+class BenchTree:
+    def __init__(self, workdir, options):
+        self.workdir = workdir
+        self.options = options
+        self.home = os.path.join(workdir, 'home')
+        self.server = os.path.join(workdir, 'server')
+        self.packages = os.path.join(self.server, 'packages')
+        self.refsrepo = os.path.join(self.server, 'Refs.git')
+        self.clones = os.path.join(workdir, 'clones')
+        self.bigheads = os.path.join(workdir, 'heads.big')
+        self.env = dict(os.environ, HOME=self.home, GIT_CONFIG_NOSYSTEM='1',
+                PYTHONPATH=TOPDIR, PYTHONDONTWRITEBYTECODE='1')
+        self.daemon = None
+
+    def setup(self):
+        os.makedirs(self.home)
+        with open(os.path.join(self.home, '.gitconfig'), 'w') as f:
+            f.write('[user]\n\tname = Bench\n\temail = bench@localhost\n[init]\n\tdefaultBranch = master\n')
+        os.makedirs(self.packages)
+        template = self.make_template()
+        self.heads = {}
+        for i in range(self.options.repos):
+            name = reponame(i)
+            shutil.copytree(template, os.path.join(self.packages, name + '.git'), symlinks=True)
+            for (ref, sha1) in self.branches.items():
+                self.heads[(name, ref)] = sha1
+        git('init', '-q', '--bare', self.refsrepo, env=self.env)
+        git('config', 'daemon.uploadarch', 'true', cwd=self.refsrepo, env=self.env)
+        self.commit_heads()
+        self.make_bigheads()
+        if self.options.git_daemon:
+            self.daemon = subprocess.Popen(['git', 'daemon', '--export-all', '--reuseaddr',
+                '--base-path=' + self.server, '--listen=127.0.0.1', '--port={}'.format(self.options.git_daemon),
+                '--enable=upload-archive', self.server], env=self.env)
+            time.sleep(1)
+            self.env['SLUG_GIT_REPO'] = 'git://127.0.0.1:{}/packages'.format(self.options.git_daemon)
+            self.env['SLUG_REFS_REPO'] = 'git://127.0.0.1:{}/Refs.git'.format(self.options.git_daemon)
+        else:
+            self.env['SLUG_GIT_REPO'] = 'file://' + self.packages
+            self.env['SLUG_REFS_REPO'] = 'file://' + self.refsrepo
+
+    def cleanup(self):
+        if self.daemon is not None:
+            self.daemon.terminate()
+            self.daemon.wait()
+
+    def make_template(self):
+        template = os.path.join(self.workdir, 'template.git')
+        source = os.path.join(self.workdir, 'template')
+        git('init', '-q', source, env=self.env)
+        with open(os.path.join(source, 'template.spec'), 'w') as f:
+            f.write('Name: template\n')
+        git('add', '.', cwd=source, env=self.env)
+        git('commit', '-q', '-m', 'init', cwd=source, env=self.env)
+        self.branches = {}
+        for i in range(1, self.options.branches):
+            git('branch', branchname(i), 'HEAD', cwd=source, env=self.env)
+        git('clone', '-q', '--bare', source, template, env=self.env)
+        if self.options.packed:
+            git('pack-refs', '--all', cwd=template, env=self.env)
+        for i in range(self.options.branches):
+            ref = 'refs/heads/' + branchname(i)
+            self.branches[ref] = git('rev-parse', ref, cwd=template, env=self.env)
+        return template
+
+    def headslines(self, heads):
+        for (repo, ref) in sorted(heads):
+            yield '{} {} {}\n'.format(heads[(repo, ref)], ref, repo)
+
+    def commit_heads(self):
+        blob = git('hash-object', '-w', '--stdin', cwd=self.refsrepo, env=self.env,
+                stdin=''.join(self.headslines(self.heads)).encode('utf-8'))
+        tree = git('mktree', cwd=self.refsrepo, env=self.env,
+                stdin='100644 blob {}\theads\n'.format(blob).encode('utf-8'))
+        clist = ['commit-tree', tree, '-m', 'Changes by bench']
+        try:
+            clist += ['-p', git('rev-parse', '-q', '--verify', 'refs/heads/master', cwd=self.refsrepo, env=self.env)]
+        except subprocess.CalledProcessError:
+            pass
+        commit = git(*clist, cwd=self.refsrepo, env=self.env)
+        git('update-ref', 'refs/heads/master', commit, cwd=self.refsrepo, env=self.env)
+
+    def make_bigheads(self):
+        rand = random.Random(0)
+        with open(self.bigheads, 'w') as f:
+            for i in range(self.options.heads_repos):
+                for j in sorted(range(self.options.branches), key=branchname):
+                    f.write('{:040x} refs/heads/{} {}\n'.format(rand.getrandbits(160), branchname(j), reponame(i)))
+
+    def advance(self, count):
+        """Add a new commit to master of count repositories and update Refs"""
+        for i in random.Random(time.time()).sample(range(self.options.repos), count):
+            name = reponame(i)
+            gitdir = os.path.join(self.packages, name + '.git')
+            parent = self.heads[(name, 'refs/heads/master')]
+            commit = git('commit-tree', parent + '^{tree}', '-p', parent, '-m', 'bench change',
+                    cwd=gitdir, env=self.env)
+            git('update-ref', 'refs/heads/master', commit, cwd=gitdir, env=self.env)
+            self.heads[(name, 'refs/heads/master')] = commit
+        self.commit_heads()
+
+    def slug(self, *args):
+        subprocess.run([sys.executable, SLUG] + list(args) + ['-d', self.clones, '-j', str(self.options.jobs)],
+                env=self.env, stdout=subprocess.DEVNULL, check=True)
+
+def bench_parse(tree, results, repeat):
+    from git_slug.refsdata import RemoteRefsData
+    with open(tree.bigheads, 'rb') as f:
+        data = f.read()
+    results['parse_all'] = timeit(lambda: RemoteRefsData(io.BytesIO(data), ('*',)), repeat)
+    names = [reponame(i) for i in range(0, tree.options.heads_repos, max(1, tree.options.heads_repos // 300))]
+    results['parse_names'] = timeit(lambda: RemoteRefsData(io.BytesIO(data), ('master',), names), repeat)
+    results['parse_prefix'] = timeit(lambda: RemoteRefsData(io.BytesIO(data), ('*',), ('pkg0001*',)), repeat)
+    snapshot = RemoteRefsData(io.BytesIO(data), ('*',))
+    results['select_names'] = timeit(lambda: snapshot.select(('master',), names), repeat)
+
+def bench_archive(tree, results, repeat):
+    from git_slug.refsdata import GitArchiveRefsData
+    results['archive_refs'] = timeit(lambda: GitArchiveRefsData(('*',)), repeat)
+
+def bench_check_remote(tree, results, repeat, label):
+    from git_slug.gitrepo import GitRepo
+    refs = sorted(tree.branches)
+    def check():
+        for i in range(tree.options.repos):
+            repo = GitRepo(os.path.join(tree.clones, reponame(i)))
+            for ref in refs:
+                repo.check_remote(ref)
+    results['check_remote_' + label] = timeit(check, repeat)
+
+def bench_fetch(tree, results, repeat):
+    start = time.perf_counter()
+    tree.slug('clone')
+    results['clone'] = time.perf_counter() - start
+    bench_check_remote(tree, results, repeat, 'loose')
+    for i in range(tree.options.repos):
+        git('pack-refs', '--all', cwd=os.path.join(tree.clones, reponame(i)), env=tree.env)
+    bench_check_remote(tree, results, repeat, 'packed')
+    results['fetch_noop'] = timeit(lambda: tree.slug('fetch'), repeat)
+    results['fetch_noop_verify'] = timeit(lambda: tree.slug('fetch', '--verify'), repeat)
+    def changed():
+        tree.advance(tree.options.changed)
+        tree.slug('fetch')
+    results['fetch_changed'] = timeit(changed, repeat)
+
+def bench_watch(tree, results, repeat):
+    try:
+        import pyinotify
+    except ImportError:
+        print('pyinotify not available, skipping slug_watch benchmark', file=sys.stderr)
+        return
+    watchroot = os.path.join(tree.workdir, 'watch')
+    refrepodir = os.path.join(watchroot, 'repositories')
+    watchdir = os.path.join(watchroot, 'watchdir')
+    os.makedirs(watchdir)
+    refsgdir = os.path.join(refrepodir, 'Refs.git')
+    git('init', '-q', '--bare', refsgdir, env=tree.env)
+    blob = git('hash-object', '-w', tree.bigheads, cwd=refsgdir, env=tree.env)
+    treeid = git('mktree', cwd=refsgdir, env=tree.env, stdin='100644 blob {}\theads\n'.format(blob).encode('utf-8'))
+    git('update-ref', 'refs/heads/master', git('commit-tree', treeid, '-m', 'init', cwd=refsgdir, env=tree.env),
+            cwd=refsgdir, env=tree.env)
+    rand = random.Random(1)
+    def process():
+        for i in range(tree.options.notifications):
+            repo = reponame(rand.randrange(tree.options.heads_repos))
+            with open(os.path.join(watchdir, '{}.{}'.format(repo, i)), 'w') as f:
+                f.write('bench\n{}\n{:040x} {:040x} refs/heads/master\n'.format(repo,
+                    rand.getrandbits(160), rand.getrandbits(160)))
+        subprocess.run([sys.executable, SLUG_WATCH, '-r', refrepodir, '-w', watchdir,
+            '--workdir', watchroot, '--once'], env=tree.env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results['watch_process'] = timeit(process, repeat)
+
+def compare(results, path):
+    with open(path, 'r') as f:
+        old = json.load(f)['results']
+    print('{:<22} {:>12} {:>12} {:>8}'.format('benchmark', 'old [s]', 'new [s]', 'ratio'))
+    for name in sorted(results):
+        if name in old and old[name]:
+            print('{:<22} {:12.4f} {:12.4f} {:8.2f}'.format(name, old[name], results[name], results[name] / old[name]))
+
+parser = ArgumentParser(description='benchmarks of slug.py and slug_watch')
+parser.add_argument('-r', '--repos', help='number of package repositories on disk', type=int, default=200)
+parser.add_argument('-b', '--branches', help='number of branches in every repository', type=int, default=3)
+parser.add_argument('--heads-repos', help='number of repositories in the synthetic heads file', type=int, default=30000)
+parser.add_argument('--packed', help='use packed refs in server repositories', action='store_true')
+parser.add_argument('--changed', help='number of repositories changed in fetch_changed benchmark', type=int, default=10)
+parser.add_argument('--notifications', help='number of notification files for slug_watch', type=int, default=20)
+parser.add_argument('-j', '--jobs', help='number of jobs used by slug.py', type=int, default=os.cpu_count() or 4)
+parser.add_argument('--repeat', help='number of repetitions of every benchmark', type=int, default=3)
+parser.add_argument('--git-daemon', help='serve repositories by git daemon on PORT instead of file:// URLs',
+        metavar='PORT', type=int)
+parser.add_argument('--workdir', help='directory for the synthetic tree, kept after the run (default: temporary directory)')
+parser.add_argument('--keep', help='do not remove the temporary work directory', action='store_true')
+parser.add_argument('-o', '--output', help='write results as JSON to FILE', metavar='FILE')
+parser.add_argument('--compare', help='compare results with JSON FILE from earlier run', metavar='FILE')
+parser.add_argument('benchmarks', nargs='*', default=['parse', 'archive', 'fetch', 'watch'],
+        help='benchmarks to run: parse, archive, fetch, watch')
+options = parser.parse_args()
+
+sys.path.insert(0, TOPDIR)
+workdir = options.workdir or tempfile.mkdtemp(prefix='slug-bench.')
+tree = BenchTree(workdir, options)
+results = {}
+try:
+    tree.setup()
+    # git_slug.gitconst reads the server URLs on import
+    os.environ.update(SLUG_GIT_REPO=tree.env['SLUG_GIT_REPO'], SLUG_REFS_REPO=tree.env['SLUG_REFS_REPO'])
+    for name in options.benchmarks:
+        if name == 'parse':
+            bench_parse(tree, results, options.repeat)
+        elif name == 'archive':
+            bench_archive(tree, results, options.repeat)
+        elif name == 'fetch':
+            bench_fetch(tree, results, options.repeat)
+        elif name == 'watch':
+            bench_watch(tree, results, options.repeat)
+        else:
+            parser.error('Unknown benchmark {}'.format(name))
+finally:
+    tree.cleanup()
+    if not (options.keep or options.workdir):
+        shutil.rmtree(workdir, ignore_errors=True)
+
+for name in sorted(results):
+    print('{:<22} {:12.4f}s'.format(name, results[name]))
+if options.output:
+    with open(options.output, 'w') as f:
+        json.dump({'parameters': {key: value for (key, value) in vars(options).items()
+            if key not in ('output', 'compare', 'workdir', 'keep')}, 'results': results}, f, indent=1)
+        f.write('\n')
+if options.compare:
+    compare(results, options.compare)
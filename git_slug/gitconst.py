@@ -1,3 +1,4 @@
+from os import environ
 from os.path import join
 
 EMPTYSHA1 = '0000000000000000000000000000000000000000'
@@ -8,7 +9,11 @@ GITLOGIN = 'git@'
 GITSERVER = 'git.pld-linux.org'
 _packages_dir = 'packages'
 _packages_remote = join(GITSERVER, _packages_dir)
-GIT_REPO = 'git://' + _packages_remote
+# SLUG_GIT_REPO and SLUG_REFS_REPO allow to use a local stand-in of the
+# server, for example in benchmarks
+GIT_REPO = environ.get('SLUG_GIT_REPO', 'git://' + _packages_remote)
 GIT_REPO_PUSH = 'ssh://' + GITLOGIN + _packages_remote
 REFREPO = 'Refs'
 REFFILE = 'heads'
+REFJOURNAL = 'journal'
+GIT_REFS_REPO = environ.get('SLUG_REFS_REPO', 'git://' + join(GITSERVER, REFREPO))
@@ -1,5 +1,6 @@
 from .gitconst import EMPTYSHA1, REMOTE_NAME, REFFILE
 
+import asyncio
 import os
 from subprocess import PIPE
 import subprocess
@@ -20,6 +21,7 @@ class GitRepo:
             self.command_prefix.append('--git-dir='+self.gdir)
         if self.wtree is not None:
             self.command_prefix.append('--work-tree='+self.wtree)
+        self.packed_refs_cache = (None, {})
 
     def command(self, clist):
         return subprocess.Popen(self.command_prefix + clist, stdout=PIPE, stderr=PIPE, bufsize=-1)
@@ -34,10 +36,27 @@ class GitRepo:
             raise GitRepoError((out + err).decode('utf-8'))
         return (out, err)
 
+    async def acommandio(self, clist):
+        """Asynchronous version of commandio"""
+        proc = await asyncio.create_subprocess_exec(*(self.command_prefix + clist), stdout=PIPE, stderr=PIPE)
+        return await proc.communicate()
+
+    async def acommandexc(self, clist):
+        """Asynchronous version of commandexc"""
+        proc = await asyncio.create_subprocess_exec(*(self.command_prefix + clist), stdout=PIPE, stderr=PIPE)
+        (out, err) = await proc.communicate()
+        if proc.returncode:
+            raise GitRepoError((out + err).decode('utf-8'))
+        return (out, err)
+
     def checkout(self, branch):
         clist = ['checkout', '-m', branch]
         return self.commandexc(clist)
 
+    async def acheckout(self, branch):
+        clist = ['checkout', '-m', branch]
+        return await self.acommandexc(clist)
+
     def commitfile(self, path, message):
         clist = ['add', path]
         self.commandexc(clist)
@@ -55,49 +74,183 @@ class GitRepo:
         except GitRepoError:
             return None
 
-    def fetch(self, fetchlist=[], depth = 0, remotename=REMOTE_NAME):
+    def fetchcommand(self, fetchlist, depth, remotename, filterspec=None):
         clist = ['fetch']
         if depth:
             clist.append('--depth={}'.format(depth))
+        if filterspec:
+            clist.append('--filter={}'.format(filterspec))
         clist += [ remotename ] + fetchlist
-        return self.commandexc(clist)
+        return clist
 
-    def init_gitdir(self):
+    def fetch(self, fetchlist=[], depth = 0, remotename=REMOTE_NAME, filterspec=None):
+        return self.commandexc(self.fetchcommand(fetchlist, depth, remotename, filterspec))
+
+    async def afetch(self, fetchlist=[], depth = 0, remotename=REMOTE_NAME, filterspec=None):
+        return await self.acommandexc(self.fetchcommand(fetchlist, depth, remotename, filterspec))
+
+    def initcommand(self):
         clist = ['git', 'init']
         if os.path.dirname(self.gdir) == self.wtree:
             clist.append(self.wtree)
         else:
             clist.extend(['--bare', self.gdir])
-        if subprocess.call(clist):
+        return clist
+
+    def init_gitdir(self):
+        if subprocess.call(self.initcommand()):
+            raise GitRepoError(self.gdir)
+
+    async def ainit_gitdir(self):
+        proc = await asyncio.create_subprocess_exec(*self.initcommand())
+        if await proc.wait():
             raise GitRepoError(self.gdir)
 
-    def init(self, remotepull, remotepush = None, remotename=REMOTE_NAME):
-        if os.path.isdir(self.gdir):
+    def init(self, remotepull, remotepush = None, remotename=REMOTE_NAME, filterspec=None, sparse=None,
+            packfetches=False):
+        """Initialize repository with remote remotename, see ainit"""
+        existed = os.path.isdir(self.gdir)
+        if existed:
             print("WARNING: Directory {} already existed".format(self.gdir), file=sys.stderr)
         self.init_gitdir()
-        self.commandio(['remote', 'add', remotename, remotepull])
-        if remotepush is not None:
-            self.commandio(['remote', 'set-url', '--push', remotename, remotepush])
-        self.commandio(['config', '--local', '--add', 'remote.{}.fetch'.format(remotename),
-            'refs/notes/*:refs/notes/*'])
+        hasremote = existed and bool(self.commandio(['config', '--local', 'remote.{}.url'.format(remotename)])[0])
+        self.writeinitconfig(hasremote, remotepull, remotepush, remotename, filterspec, sparse, packfetches)
 
-    def check_remote(self, ref, remote=REMOTE_NAME):
-        localref = EMPTYSHA1
-        ref = ref.replace(REFFILE, os.path.join('remotes', remote))
+    async def ainit(self, remotepull, remotepush = None, remotename=REMOTE_NAME, filterspec=None, sparse=None,
+            packfetches=False):
+        """Initialize repository with remote remotename
+
+        filterspec makes the remote a promisor remote of a partial clone,
+        later fetches from it use the filter. sparse is a list of patterns
+        of files to checkout. packfetches makes fetch keep all received
+        objects in packs."""
+        existed = os.path.isdir(self.gdir)
+        if existed:
+            print("WARNING: Directory {} already existed".format(self.gdir), file=sys.stderr)
+        await self.ainit_gitdir()
+        hasremote = existed and bool((await self.acommandio(['config', '--local', 'remote.{}.url'.format(remotename)]))[0])
+        self.writeinitconfig(hasremote, remotepull, remotepush, remotename, filterspec, sparse, packfetches)
+
+    def writeinitconfig(self, hasremote, remotepull, remotepush, remotename, filterspec, sparse, packfetches):
+        remote = None
+        if not hasremote:
+            remote = [('url', remotepull)]
+            if remotepush is not None:
+                remote.append(('pushurl', remotepush))
+            remote += [('fetch', '+refs/heads/*:refs/remotes/{}/*'.format(remotename)),
+                ('fetch', 'refs/notes/*:refs/notes/*')]
+            if filterspec:
+                remote += [('promisor', 'true'), ('partialclonefilter', filterspec)]
+        # the whole configuration is appended at once instead of running git remote and git config
+        with open(os.path.join(self.gdir, 'config'), 'a') as f:
+            if remote is not None:
+                f.write('[remote "{}"]\n'.format(remotename))
+                for (key, value) in remote:
+                    f.write('\t{} = "{}"\n'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')))
+            if sparse:
+                f.write('[core]\n\tsparseCheckout = true\n')
+            if packfetches:
+                f.write('[fetch]\n\tunpackLimit = 1\n')
+        if sparse:
+            os.makedirs(os.path.join(self.gdir, 'info'), exist_ok=True)
+            with open(os.path.join(self.gdir, 'info', 'sparse-checkout'), 'w') as f:
+                for pattern in sparse:
+                    f.write(pattern + '\n')
+
+    def packed_refs(self):
+        """Return dict of refs stored in packed-refs file
+
+        The file is parsed once and parsed again only after it has been
+        rewritten."""
+        path = os.path.join(self.gdir, 'packed-refs')
         try:
-            with open(os.path.join(self.gdir, ref), 'r') as f:
-                localref = f.readline().strip()
-        except IOError:
+            st = os.stat(path)
+        except OSError:
+            self.packed_refs_cache = (None, {})
+            return self.packed_refs_cache[1]
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self.packed_refs_cache[0] != stamp:
+            refs = {}
             try:
-                with open(os.path.join(self.gdir, 'packed-refs')) as f:
+                with open(path) as f:
                     for line in f:
                         line_data = line.split()
-                        if len(line_data) == 2 and line_data[1] == ref:
-                            localref = line_data[0].strip()
-                            break
+                        if len(line_data) == 2 and not line.startswith('#'):
+                            refs[line_data[1]] = line_data[0]
             except IOError:
                 pass
-        return localref
+            self.packed_refs_cache = (stamp, refs)
+        return self.packed_refs_cache[1]
+
+    def check_remotes(self, refs, remote=REMOTE_NAME):
+        """Return dict mapping upstream refs to SHA1 of local remote-tracking refs"""
+        localrefs = {}
+        packed = None
+        for ref in refs:
+            localref = ref.replace(REFFILE, os.path.join('remotes', remote), 1)
+            try:
+                with open(os.path.join(self.gdir, localref), 'r') as f:
+                    localrefs[ref] = f.readline().strip()
+            except IOError:
+                if packed is None:
+                    packed = self.packed_refs()
+                localrefs[ref] = packed.get(localref, EMPTYSHA1)
+        return localrefs
+
+    def check_remote(self, ref, remote=REMOTE_NAME):
+        return self.check_remotes((ref,), remote)[ref]
+
+    def read_ref(self, ref):
+        """Return SHA1 the ref points to, reading it without running git
+
+        Return None if the ref does not exist. HEAD and other symbolic refs
+        are followed."""
+        for _ in range(5):
+            try:
+                with open(os.path.join(self.gdir, ref), 'r') as f:
+                    value = f.readline().strip()
+            except IOError:
+                return self.packed_refs().get(ref)
+            if not value.startswith('ref: '):
+                return value or None
+            ref = value[len('ref: '):]
+        return None
+
+    def head(self):
+        """Return (branch, SHA1) of HEAD, branch is None for detached HEAD"""
+        try:
+            with open(os.path.join(self.gdir, 'HEAD'), 'r') as f:
+                value = f.readline().strip()
+        except IOError:
+            return (None, None)
+        if value.startswith('ref: '):
+            branch = value[len('ref: '):]
+            return (branch, self.read_ref(branch))
+        return (None, value)
+
+    def resolve(self, name):
+        """Return (full ref name, SHA1) of the ref name refers to, as git rev-parse would find it
+
+        Return (None, None) if name is not a ref."""
+        for ref in (name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name,
+                'refs/remotes/' + name, 'refs/remotes/' + name + '/HEAD'):
+            if ref.startswith('refs/'):
+                sha1 = self.read_ref(ref)
+                if sha1 is not None:
+                    return (ref, sha1)
+        return (None, None)
+
+    def packsize(self):
+        """Return total size of pack files of the repository"""
+        size = 0
+        try:
+            with os.scandir(os.path.join(self.gdir, 'objects', 'pack')) as it:
+                for entry in it:
+                    if entry.name.endswith('.pack'):
+                        size += entry.stat().st_size
+        except OSError:
+            pass
+        return size
 
     def showfile(self, filename, ref="/".join([REMOTE_NAME, "master"])):
         clist = ['show', ref + ':' + filename]
@@ -0,0 +1,39 @@
+import os
+
+
+class FetchHistory:
+    """Duration and size of previous fetches of local repositories
+
+    The data is kept in a text file with one '<seconds> <bytes> <repo>'
+    line per repository. A new measurement is averaged with the previous
+    one, so a single unusual fetch does not change the schedule much."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    (duration, size, repo) = line.split()
+                    self.data[repo] = (float(duration), int(size))
+        except (IOError, ValueError):
+            pass
+
+    def duration(self, repo):
+        return self.data.get(repo, (0.0, 0))[0]
+
+    def size(self, repo):
+        return self.data.get(repo, (0.0, 0))[1]
+
+    def record(self, repo, duration, size):
+        if repo in self.data:
+            (oldduration, oldsize) = self.data[repo]
+            duration = (duration + oldduration) / 2
+            size = (size + oldsize) // 2
+        self.data[repo] = (duration, size)
+
+    def save(self):
+        with open(self.path + '.new', 'w') as f:
+            for repo in sorted(self.data):
+                f.write('{:.3f} {} {}\n'.format(self.data[repo][0], self.data[repo][1], repo))
+        os.rename(self.path + '.new', self.path)
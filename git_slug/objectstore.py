@@ -0,0 +1,89 @@
+import os
+import shutil
+
+from .gitrepo import GitRepo
+
+
+class ObjectStore:
+    """Bare repository whose objects are shared by local repositories
+
+    Repositories list objects directory of the store in their
+    objects/info/alternates file and their packs are moved into it. The
+    store has no refs, so it must never be garbage collected; gc.auto is
+    disabled in it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.repo = GitRepo(git_dir=path)
+        if not os.path.isdir(self.objects):
+            self.repo.commandexc(['init', '--bare', '-q', path])
+            self.repo.commandexc(['config', 'gc.auto', '0'])
+
+    @staticmethod
+    def alternatesfile(gitrepo):
+        return os.path.join(gitrepo.gdir, 'objects', 'info', 'alternates')
+
+    def attached(self, gitrepo):
+        try:
+            with open(self.alternatesfile(gitrepo), 'r') as f:
+                return self.objects in (line.strip() for line in f)
+        except IOError:
+            return False
+
+    def addalternate(self, gitrepo):
+        """Add the store to alternates of gitrepo"""
+        if self.attached(gitrepo):
+            return
+        os.makedirs(os.path.dirname(self.alternatesfile(gitrepo)), exist_ok=True)
+        with open(self.alternatesfile(gitrepo), 'a') as f:
+            f.write(self.objects + '\n')
+
+    def attach(self, gitrepo):
+        """Add the store to alternates of existing gitrepo"""
+        self.addalternate(gitrepo)
+        # keep fetched objects in packs, loose objects would stay in gitrepo
+        gitrepo.commandexc(['config', '--local', 'fetch.unpackLimit', '1'])
+
+    def link(self, source, target):
+        """Hardlink source to target, copying it on other filesystem"""
+        if os.path.exists(target):
+            return
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target + '.tmp')
+            os.rename(target + '.tmp', target)
+
+    def deposit(self, gitrepo):
+        """Move packs of attached gitrepo into the store, return their size
+
+        A pack is linked into the store before its index and the index is
+        removed from gitrepo before the pack, so every object is always
+        reachable. Packs being written (with .keep file) and packs of
+        partial clones (with .promisor file) stay in gitrepo."""
+        if not self.attached(gitrepo):
+            return 0
+        packdir = os.path.join(gitrepo.gdir, 'objects', 'pack')
+        storepackdir = os.path.join(self.objects, 'pack')
+        size = 0
+        try:
+            names = os.listdir(packdir)
+        except OSError:
+            return 0
+        for name in names:
+            if not name.endswith('.idx'):
+                continue
+            base = name[:-len('.idx')]
+            if base + '.keep' in names or base + '.promisor' in names or base + '.pack' not in names:
+                continue
+            pack = os.path.join(packdir, base + '.pack')
+            size += os.path.getsize(pack)
+            self.link(pack, os.path.join(storepackdir, base + '.pack'))
+            self.link(os.path.join(packdir, name), os.path.join(storepackdir, name))
+            for suffix in ('.idx', '.rev', '.bitmap', '.pack'):
+                try:
+                    os.unlink(os.path.join(packdir, base + suffix))
+                except FileNotFoundError:
+                    pass
+        return size
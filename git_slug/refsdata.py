@@ -1,11 +1,17 @@
 
+import binascii
+import bisect
 import collections
+import collections.abc
+import fcntl
 import fnmatch
 import os
 import re
+import sys
 import tarfile
-from .gitconst import EMPTYSHA1, REFFILE, REFREPO, GITSERVER
-from .gitrepo import GitRepo
+import time
+from .gitconst import EMPTYSHA1, REFFILE, REFJOURNAL, GIT_REFS_REPO
+from .gitrepo import GitRepo, GitRepoError
 
 
 class RemoteRefsError(Exception):
@@ -14,49 +20,565 @@ class RemoteRefsError(Exception):
 class NoMatchedRepos(Exception):
     pass
 
+class NameMatcher:
+    """Match names against a list of shell patterns
+
+    Plain names are looked up in a set and patterns with only one trailing
+    '*' are checked against a sorted list of prefixes. Only the remaining
+    patterns are compiled into a regular expression."""
+
+    MAGIC = ('*', '?', '[')
+
+    def __init__(self, patterns):
+        self.exact = set()
+        prefixes = []
+        others = []
+        for pattern in patterns:
+            if not any(c in pattern for c in self.MAGIC):
+                self.exact.add(pattern)
+            elif pattern.endswith('*') and not any(c in pattern[:-1] for c in self.MAGIC):
+                prefixes.append(pattern[:-1])
+            else:
+                others.append(pattern)
+        # no prefix in the list starts with another one, so the only
+        # candidate for a prefix of a name is the largest one not above it
+        self.prefixes = []
+        for prefix in sorted(prefixes):
+            if not self.prefixes or not prefix.startswith(self.prefixes[-1]):
+                self.prefixes.append(prefix)
+        self.matchall = self.prefixes == ['']
+        if others:
+            self.regex = re.compile('|'.join(fnmatch.translate(p) for p in others))
+        else:
+            self.regex = None
+
+    def match(self, name):
+        if self.matchall or name in self.exact:
+            return True
+        if self.prefixes:
+            i = bisect.bisect_right(self.prefixes, name)
+            if i and name.startswith(self.prefixes[i-1]):
+                return True
+        return self.regex is not None and self.regex.match(name) is not None
+
+def compile_patterns(pattern, dirpattern):
+    pats = NameMatcher([os.path.join('refs/heads', p) for p in pattern])
+    dirpat = NameMatcher(dirpattern)
+    return (pats, dirpat)
+
+class RepoHeads(collections.abc.Mapping):
+    """Heads of one repository
+
+    Ref names are kept sorted in a tuple of interned strings and SHA1s are
+    packed in binary form, 20 bytes per ref, in one bytes object. Missing
+    refs map to EMPTYSHA1."""
+
+    __slots__ = ('refs', 'sha1s')
+
+    def __init__(self, refs=(), sha1s=b''):
+        self.refs = refs
+        self.sha1s = sha1s
+
+    def index(self, ref):
+        i = bisect.bisect_left(self.refs, ref)
+        if i < len(self.refs) and self.refs[i] == ref:
+            return i
+        return -1
+
+    def __getitem__(self, ref):
+        i = self.index(ref)
+        if i < 0:
+            return EMPTYSHA1
+        return self.sha1s[20*i:20*i+20].hex()
+
+    def __contains__(self, ref):
+        return self.index(ref) >= 0
+
+    def get(self, ref, default=None):
+        i = self.index(ref)
+        if i < 0:
+            return default
+        return self.sha1s[20*i:20*i+20].hex()
+
+    def __iter__(self):
+        return iter(self.refs)
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def rawitems(self):
+        for (i, ref) in enumerate(self.refs):
+            yield (ref, self.sha1s[20*i:20*i+20])
+
+    @classmethod
+    def fromitems(cls, items):
+        """Create RepoHeads from (ref, binary sha1) pairs"""
+        items = sorted(items)
+        return cls(tuple(sys.intern(ref) for (ref, sha1) in items), b''.join(sha1 for (ref, sha1) in items))
+
+NOHEADS = RepoHeads()
+
+class RefsHeads(collections.abc.Mapping):
+    """Mapping of repository names to their RepoHeads
+
+    Repository names are kept in a sorted list, so iteration in sorted order
+    costs nothing. Unknown repositories map to empty RepoHeads."""
+
+    __slots__ = ('names', 'repos')
+
+    def __init__(self):
+        self.names = []
+        self.repos = {}
+
+    def __getitem__(self, repo):
+        return self.repos.get(repo, NOHEADS)
+
+    def __contains__(self, repo):
+        return repo in self.repos
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def set(self, repo, repoheads):
+        if not repoheads:
+            self.pop(repo)
+            return
+        if repo not in self.repos:
+            repo = sys.intern(repo)
+            if self.names and repo < self.names[-1]:
+                bisect.insort(self.names, repo)
+            else:
+                self.names.append(repo)
+        self.repos[repo] = repoheads
+
+    def pop(self, repo, default=None):
+        repoheads = self.repos.pop(repo, None)
+        if repoheads is None:
+            return default
+        del self.names[bisect.bisect_left(self.names, repo)]
+        return repoheads
+
 class RemoteRefsData:
     def __init__(self, stream, pattern, dirpattern=('*',)):
-        self.heads = collections.defaultdict(self.__dict_var__)
-        pats = re.compile('|'.join(fnmatch.translate(os.path.join('refs/heads', p)) for p in pattern))
-        dirpat = re.compile('|'.join(fnmatch.translate(p) for p in dirpattern))
-        for line in stream.readlines():
+        self.heads = RefsHeads()
+        (pats, dirpat) = compile_patterns(pattern, dirpattern)
+        current = None
+        items = []
+        for line in stream:
             if isinstance(line, bytes):
                 line = line.decode("utf-8")
             (sha1, ref, repo) = line.split()
-            if pats.match(ref) and dirpat.match(repo):
-                self.heads[repo][ref] = sha1
+            if repo != current:
+                self.addrepo(current, items)
+                current = repo
+                items = []
+                repomatch = dirpat.match(repo)
+            if repomatch and pats.match(ref):
+                items.append((ref, binascii.unhexlify(sha1)))
+        self.addrepo(current, items)
         if not self.heads:
             raise NoMatchedRepos
 
-    def __dict_init__(self):
-        return EMPTYSHA1
+    @classmethod
+    def fromheads(cls, heads):
+        """Create refs data from RefsHeads without parsing any stream"""
+        refs = cls.__new__(cls)
+        refs.heads = heads
+        return refs
+
+    def addrepo(self, repo, items):
+        if not items:
+            return
+        if repo in self.heads:
+            items = list(self.heads[repo].rawitems()) + items
+        self.heads.set(repo, RepoHeads.fromitems(items))
+
+    def select(self, pattern, dirpattern=('*',)):
+        """Return RemoteRefsData limited to the refs matching given patterns
+
+        The refs are filtered in memory, so one downloaded snapshot can be
+        shared by all commands run in one process."""
+        refs = RemoteRefsData.fromheads(RefsHeads())
+        (pats, dirpat) = compile_patterns(pattern, dirpattern)
+        for repo in self.heads:
+            if dirpat.match(repo):
+                repoheads = self.heads[repo]
+                if all(pats.match(ref) for ref in repoheads):
+                    refs.heads.set(repo, repoheads)
+                else:
+                    refs.heads.set(repo, RepoHeads.fromitems((ref, sha1)
+                        for (ref, sha1) in repoheads.rawitems() if pats.match(ref)))
+        if not refs.heads:
+            raise NoMatchedRepos
+        return refs
+
+    def update(self, repo, refs_heads):
+        """Set heads of repository repo, EMPTYSHA1 removes the ref"""
+        items = dict(self.heads[repo].rawitems())
+        for ref in refs_heads:
+            if refs_heads[ref] == EMPTYSHA1:
+                items.pop(ref, None)
+            else:
+                items[ref] = binascii.unhexlify(refs_heads[ref])
+        self.heads.set(repo, RepoHeads.fromitems(items.items()))
 
-    def __dict_var__(self):
-        return collections.defaultdict(self.__dict_init__)
+    def remove(self, repo):
+        self.heads.pop(repo)
 
     def put(self, repo, data):
+        refs_heads = {}
         for line in data:
             (sha1_old, sha1, ref) = line.split()
             if(ref.startswith('refs/heads/')):
-                self.heads[repo][ref] = sha1
+                refs_heads[ref] = sha1
+        self.update(repo, refs_heads)
+
+    def dump(self, stream):
+        for repo in self.heads:
+            for (ref, sha1) in self.heads[repo].rawitems():
+                stream.write('{} {} {}\n'.format(sha1.hex(), ref, repo))
+
+class ChangeJournal:
+    """Sequence-numbered list of changes of heads
+
+    The first line 'seq <seq>' holds the current sequence number, so it is
+    kept also when no change is left in the journal. Every other line has
+    form '<seq> <repo> <ref> <old sha1> <new sha1>'. Only the most recent
+    changes are kept, a client which has seen an older sequence number has
+    to download the whole heads file."""
+
+    def __init__(self, stream=()):
+        self.entries = collections.deque()
+        self.seq = 0
+        for line in stream:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if line.startswith('seq '):
+                self.seq = max(self.seq, int(line.split()[1]))
+                continue
+            (seq, repo, ref, sha1_old, sha1) = line.split()
+            self.seq = max(self.seq, int(seq))
+            self.entries.append((int(seq), repo, ref, sha1_old, sha1))
+
+    def append(self, repo, ref, sha1_old, sha1):
+        self.seq += 1
+        self.entries.append((self.seq, repo, ref, sha1_old, sha1))
+
+    def reset(self):
+        """Forget all changes, so every client downloads the heads file again"""
+        self.entries.clear()
+        self.seq += 1
+
+    def compact(self, size):
+        """Keep only the last size changes once the journal is twice as long"""
+        if len(self.entries) > 2 * size:
+            while len(self.entries) > size:
+                self.entries.popleft()
+
+    def since(self, seq):
+        """Return changes made after seq or None if some of them are already forgotten"""
+        firstseq = self.entries[0][0] if self.entries else self.seq + 1
+        if seq > self.seq or seq < firstseq - 1:
+            return None
+        return [entry for entry in self.entries if entry[0] > seq]
 
     def dump(self, stream):
-        for repo in sorted(self.heads):
-            for ref in sorted(self.heads[repo]):
-                if self.heads[repo][ref] != EMPTYSHA1:
-                    stream.write('{} {} {}\n'.format(self.heads[repo][ref], ref, repo))
+        stream.write('seq {}\n'.format(self.seq))
+        for entry in self.entries:
+            stream.write('{} {} {} {} {}\n'.format(*entry))
+
+class LocalRefsData(RemoteRefsData):
+    """Remote-tracking refs of local repositories recorded in one file
+
+    The file has the same format as the heads file in Refs repository, so
+    comparing it with RemoteRefsData does not require to look into .git
+    directories of local repositories."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                RemoteRefsData.__init__(self, f, ('*',))
+        except (IOError, ValueError, NoMatchedRepos):
+            self.heads = RefsHeads()
+
+    def uptodate(self, repo, refs_heads):
+        if repo not in self.heads:
+            return False
+        localrefs = self.heads[repo]
+        return all(localrefs[ref] == refs_heads[ref] for ref in refs_heads)
+
+    def save(self):
+        with open(self.path + '.new', 'w') as f:
+            self.dump(f)
+        os.rename(self.path + '.new', self.path)
+
+class CountingReader:
+    """File object wrapper counting the number of bytes read"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+def openarchive(paths):
+    """Start download of files paths from Refs repository with git archive
+
+    Return (process, CountingReader, tarfile) tuple."""
+    archcmd = GitRepo(None, None).command(['archive', '--format=tgz', '--remote={}'.format(GIT_REFS_REPO),
+        'HEAD'] + list(paths))
+    archive = CountingReader(archcmd.stdout)
+    try:
+        tar = tarfile.open(fileobj=archive, mode='r|*')
+    except tarfile.TarError:
+        archcmd.wait()
+        raise RemoteRefsError(paths[0], GIT_REFS_REPO)
+    return (archcmd, archive, tar)
 
 class GitArchiveRefsData(RemoteRefsData):
     def __init__(self, pattern, dirpattern=('*')):
-        fullrefrepo = 'git://{}/{}'.format(GITSERVER, REFREPO)
-        archcmd = GitRepo(None, None).command(['archive', '--format=tgz', '--remote={}'.format(fullrefrepo), 'HEAD'])
-        try:
-            tar = tarfile.open(fileobj=archcmd.stdout, mode='r|*')
-        except tarfile.TarError:
-            raise RemoteRefsError(REFFILE, fullrefrepo)
+        fullrefrepo = GIT_REFS_REPO
+        (archcmd, archive, tar) = openarchive((REFFILE,))
         member = tar.next()
-        if member.name != REFFILE:
+        if member is None or member.name != REFFILE:
             raise RemoteRefsError(REFFILE, fullrefrepo)
         RemoteRefsData.__init__(self, tar.extractfile(member), pattern, dirpattern)
+        self.archivesize = archive.size
         if archcmd.wait():
             raise RemoteRefsError(REFFILE, fullrefrepo)
+
+class GitJournalRefsData(RemoteRefsData):
+    """Refs data kept in a local cache file and updated from change journal
+
+    Only the journal is downloaded if it still contains all changes made
+    since the cache was written. Otherwise the heads file and the journal
+    are downloaded together and the cache is written again."""
+
+    def __init__(self, cachefile, pattern, dirpattern=('*',)):
+        self.archivesize = 0
+        seq = self.readcache(cachefile)
+        if seq is not None:
+            (archcmd, archive, tar) = openarchive((REFJOURNAL,))
+            member = tar.next()
+            if member is None or member.name != REFJOURNAL:
+                raise RemoteRefsError(REFJOURNAL, GIT_REFS_REPO)
+            journal = ChangeJournal(tar.extractfile(member))
+            self.archivesize += archive.size
+            if archcmd.wait():
+                raise RemoteRefsError(REFJOURNAL, GIT_REFS_REPO)
+            changes = journal.since(seq)
+            if changes is None:
+                seq = None
+            else:
+                for (_, repo, ref, sha1_old, sha1) in changes:
+                    self.update(repo, {ref: sha1})
+        if seq is None:
+            (archcmd, archive, tar) = openarchive((REFFILE, REFJOURNAL))
+            member = tar.next()
+            if member is None or member.name != REFFILE:
+                raise RemoteRefsError(REFFILE, GIT_REFS_REPO)
+            RemoteRefsData.__init__(self, tar.extractfile(member), ('*',))
+            member = tar.next()
+            if member is None or member.name != REFJOURNAL:
+                raise RemoteRefsError(REFJOURNAL, GIT_REFS_REPO)
+            journal = ChangeJournal(tar.extractfile(member))
+            self.archivesize += archive.size
+            if archcmd.wait():
+                raise RemoteRefsError(REFFILE, GIT_REFS_REPO)
+        self.seq = journal.seq
+        self.writecache(cachefile)
+        if tuple(pattern) != ('*',) or tuple(dirpattern) != ('*',):
+            self.heads = self.select(pattern, dirpattern).heads
+
+    def readcache(self, cachefile):
+        """Read heads from cache file, return their sequence number or None"""
+        try:
+            with open(cachefile, 'r') as f:
+                seq = int(f.readline())
+                RemoteRefsData.__init__(self, f, ('*',))
+                return seq
+        except (IOError, ValueError, NoMatchedRepos):
+            return None
+
+    def writecache(self, cachefile):
+        os.makedirs(os.path.dirname(cachefile) or '.', exist_ok=True)
+        with open(cachefile + '.new', 'w') as f:
+            f.write('{}\n'.format(self.seq))
+            self.dump(f)
+        os.rename(cachefile + '.new', cachefile)
+
+class SharedRefsData(RemoteRefsData):
+    """Refs data downloaded once for all local users of a cache directory
+
+    The cache file in cachedir holds SHA1 of HEAD of the Refs repository in
+    the first line and the heads file taken from it in the following ones.
+    It is used without asking the server while it is younger than maxage
+    seconds. Then HEAD of the Refs repository is checked with git ls-remote
+    and the heads file is downloaded again only if HEAD has changed. Only
+    one process checks the server at a time, the others wait for it on the
+    lock file and then use the refreshed cache. If the cache directory
+    cannot be used, the heads file is downloaded without caching it."""
+
+    CACHEFILE = 'heads'
+    LOCKFILE = 'lock'
+
+    def __init__(self, cachedir, pattern, dirpattern=('*',), maxage=60):
+        self.archivesize = 0
+        cachefile = os.path.join(cachedir, self.CACHEFILE)
+        if self.fresh(cachefile, maxage) and self.readcache(cachefile, pattern, dirpattern):
+            return
+        try:
+            self.makecachedir(cachedir)
+            lock = open(os.path.join(cachedir, self.LOCKFILE), 'a')
+        except OSError as e:
+            print("WARNING: Cannot use refs cache {}: {}".format(cachedir, e), file=sys.stderr)
+            data = GitArchiveRefsData(pattern, dirpattern)
+            (self.heads, self.archivesize) = (data.heads, data.archivesize)
+            return
+        with lock:
+            self.share(lock.name)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.fresh(cachefile, maxage) and self.readcache(cachefile, pattern, dirpattern):
+                return
+            head = self.remotehead()
+            if head is not None and head == self.cachedhead(cachefile):
+                try:
+                    os.utime(cachefile)
+                except OSError:
+                    pass
+                if self.readcache(cachefile, pattern, dirpattern):
+                    return
+            (archcmd, archive, tar) = openarchive((REFFILE,))
+            member = tar.next()
+            if member is None or member.name != REFFILE:
+                raise RemoteRefsError(REFFILE, GIT_REFS_REPO)
+            RemoteRefsData.__init__(self, tar.extractfile(member), ('*',))
+            self.archivesize = archive.size
+            if archcmd.wait():
+                raise RemoteRefsError(REFFILE, GIT_REFS_REPO)
+            try:
+                self.writecache(cachefile, head or EMPTYSHA1)
+            except OSError as e:
+                print("WARNING: Cannot write refs cache {}: {}".format(cachefile, e), file=sys.stderr)
+        if tuple(pattern) != ('*',) or tuple(dirpattern) != ('*',):
+            self.heads = self.select(pattern, dirpattern).heads
+
+    @staticmethod
+    def makecachedir(cachedir):
+        """Create cachedir writable for its group, new files in it inherit the group"""
+        if os.path.isdir(cachedir):
+            return
+        os.makedirs(cachedir, mode=0o2775, exist_ok=True)
+        try:
+            # mode of makedirs is limited by umask
+            os.chmod(cachedir, 0o2775)
+        except OSError:
+            pass
+
+    @staticmethod
+    def share(path):
+        """Let other users of the group of the cache directory write to path"""
+        try:
+            os.chmod(path, 0o664)
+        except OSError:
+            pass
+
+    @staticmethod
+    def fresh(cachefile, maxage):
+        try:
+            return time.time() - os.stat(cachefile).st_mtime < maxage
+        except OSError:
+            return False
+
+    @staticmethod
+    def remotehead():
+        (out, err) = GitRepo(None, None).commandio(['ls-remote', GIT_REFS_REPO, 'HEAD'])
+        fields = out.decode('utf-8').split()
+        return fields[0] if fields else None
+
+    @staticmethod
+    def cachedhead(cachefile):
+        try:
+            with open(cachefile, 'r') as f:
+                return f.readline().strip()
+        except IOError:
+            return None
+
+    def readcache(self, cachefile, pattern, dirpattern):
+        """Read heads matching patterns from cache file, return False if it cannot be read"""
+        try:
+            with open(cachefile, 'r') as f:
+                f.readline()
+                RemoteRefsData.__init__(self, f, pattern, dirpattern)
+                return True
+        except (IOError, ValueError):
+            return False
+
+    def writecache(self, cachefile, head):
+        with open(cachefile + '.new', 'w') as f:
+            f.write('{}\n'.format(head))
+            self.dump(f)
+        self.share(cachefile + '.new')
+        os.rename(cachefile + '.new', cachefile)
+
+class GitMirrorRefsData(RemoteRefsData):
+    """Refs data read from a local mirror of the Refs repository
+
+    Only the commits made since the last run are transferred from the server.
+    The mirror also remembers which Refs commit the local repositories were
+    last synchronized with, so the repositories with changed heads can be
+    found without looking into them."""
+
+    MIRRORREF = 'refs/remotes/origin/master'
+    SYNCEDREFS = 'refs/synced/'
+
+    def __init__(self, mirrordir, pattern, dirpattern=('*',)):
+        fullrefrepo = GIT_REFS_REPO
+        self.mirror = GitRepo(git_dir=mirrordir)
+        try:
+            if not os.path.isdir(mirrordir):
+                self.mirror.init_gitdir()
+            self.mirror.commandexc(['fetch', '-q', fullrefrepo, '+HEAD:' + self.MIRRORREF])
+            self.commit = self.mirror.commandexc(['rev-parse', '--verify', self.MIRRORREF])[0].decode('utf-8').strip()
+        except GitRepoError:
+            raise RemoteRefsError(REFFILE, fullrefrepo)
+        showcmd = self.mirror.showfile(REFFILE, self.commit)
+        RemoteRefsData.__init__(self, showcmd.stdout, pattern, dirpattern)
+        if showcmd.wait():
+            raise RemoteRefsError(REFFILE, mirrordir)
+
+    def synced(self, key):
+        (out, err) = self.mirror.commandio(['rev-parse', '-q', '--verify', self.SYNCEDREFS + key])
+        return out.decode('utf-8').strip() or None
+
+    def mark_synced(self, key):
+        self.mirror.commandexc(['update-ref', self.SYNCEDREFS + key, self.commit])
+
+    def changed_repos(self, since):
+        """Return set of repositories whose heads changed since Refs commit since
+
+        None is returned if the set cannot be computed and all repositories
+        have to be checked."""
+        if since is None:
+            return None
+        try:
+            (out, err) = self.mirror.commandexc(['diff', '--no-color', '--no-ext-diff', '-U0',
+                since, self.commit, '--', REFFILE])
+        except GitRepoError:
+            return None
+        repos = set()
+        for line in out.decode('utf-8').splitlines():
+            if line.startswith(('+', '-')) and not line.startswith(('+++ ', '--- ')):
+                line_data = line[1:].split()
+                if len(line_data) == 3:
+                    repos.add(line_data[2])
+        return repos
@@ -0,0 +1,52 @@
+import os
+
+
+class SpecIndex:
+    """Spec files on master branches of repositories
+
+    The index is kept in a text file with one '<spec> <repo>' line per spec
+    file, sorted by spec name, and is written only by slug_watch."""
+
+    def __init__(self, path):
+        self.path = path
+        self.specs = {}
+        self.owners = {}
+        self.loaded = False
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    (spec, repo) = line.rstrip('\n').rsplit(' ', 1)
+                    self.specs.setdefault(repo, set()).add(spec)
+                    self.owners.setdefault(spec, set()).add(repo)
+            self.loaded = True
+        except (IOError, ValueError):
+            self.specs = {}
+            self.owners = {}
+
+    def repos(self, spec):
+        """Return sorted list of repositories with spec file spec"""
+        return sorted(self.owners.get(spec, ()))
+
+    def repospecs(self, repo):
+        """Return sorted list of spec files of repository repo"""
+        return sorted(self.specs.get(repo, ()))
+
+    def remove(self, repo):
+        for spec in self.specs.pop(repo, ()):
+            self.owners[spec].discard(repo)
+            if not self.owners[spec]:
+                del self.owners[spec]
+
+    def set(self, repo, specs):
+        self.remove(repo)
+        if specs:
+            self.specs[repo] = set(specs)
+            for spec in specs:
+                self.owners.setdefault(spec, set()).add(repo)
+
+    def save(self):
+        with open(self.path + '.new', 'w') as f:
+            for spec in sorted(self.owners):
+                for repo in sorted(self.owners[spec]):
+                    f.write('{} {}\n'.format(spec, repo))
+        os.rename(self.path + '.new', self.path)
@@ -0,0 +1,87 @@
+import contextlib
+import csv
+import json
+import time
+
+
+class Stats:
+    """Timing and size measurements of one run
+
+    Phases are named steps of the whole run, repo entries describe single
+    git operations in one repository and worker entries tell how long every
+    worker of a job engine run was busy."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = []
+        self.repos = []
+        self.workers = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def repo(self, repo, phase, duration, size=0):
+        self.repos.append((repo, phase, duration, size))
+
+    def worker(self, phase, busy, wall):
+        self.workers.append((phase, busy, wall))
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def asdict(self):
+        return {
+            'total': time.monotonic() - self.start,
+            'phases': [{'phase': name, 'seconds': duration} for (name, duration) in self.phases],
+            'counters': dict(self.counters),
+            'repos': [{'repo': repo, 'phase': phase, 'seconds': duration, 'bytes': size}
+                for (repo, phase, duration, size) in self.repos],
+            'workers': [{'phase': phase, 'busy': busy, 'utilization': busy / wall if wall else 0.0}
+                for (phase, busy, wall) in self.workers],
+        }
+
+    def write(self, path):
+        """Write measurements to path, as CSV if its name ends with .csv and as JSON otherwise"""
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                self.writecsv(f)
+            else:
+                json.dump(self.asdict(), f, indent=1)
+                f.write('\n')
+
+    def writecsv(self, stream):
+        out = csv.writer(stream)
+        out.writerow(('type', 'name', 'phase', 'seconds', 'bytes', 'utilization'))
+        out.writerow(('total', '', '', '{:.6f}'.format(time.monotonic() - self.start), ''))
+        for (name, duration) in self.phases:
+            out.writerow(('phase', '', name, '{:.6f}'.format(duration), ''))
+        for name in sorted(self.counters):
+            out.writerow(('counter', name, '', '', self.counters[name]))
+        for (repo, phase, duration, size) in self.repos:
+            out.writerow(('repo', repo, phase, '{:.6f}'.format(duration), size))
+        for (i, (phase, busy, wall)) in enumerate(self.workers):
+            out.writerow(('worker', i, phase, '{:.6f}'.format(busy), '',
+                '{:.3f}'.format(busy / wall if wall else 0.0)))
+
+    def summary(self, stream):
+        print('Total time: {:.2f}s'.format(time.monotonic() - self.start), file=stream)
+        for (name, duration) in self.phases:
+            print('  {:<20} {:10.2f}s'.format(name, duration), file=stream)
+        for name in sorted(self.counters):
+            print('  {:<20} {:10}'.format(name, self.counters[name]), file=stream)
+        phases = sorted(set(phase for (phase, busy, wall) in self.workers))
+        for phase in phases:
+            busy = [b / w for (p, b, w) in self.workers if p == phase and w]
+            if busy:
+                print('  {:<20} {:9.0f}% worker utilization'.format(phase, 100 * sum(busy) / len(busy)), file=stream)
+        slowest = sorted(self.repos, key=lambda r: r[2], reverse=True)[:10]
+        if slowest:
+            print('Slowest operations:', file=stream)
+            for (repo, phase, duration, size) in slowest:
+                print('  {:<30} {:<10} {:8.2f}s {:12} bytes'.format(repo, phase, duration, size), file=stream)
@@ -1,6 +1,40 @@
 import os
+import socket
+import sys
 import tempfile
 
+SOCKET_TIMEOUT = 10
+
+def send(socketpath, payload):
+    """Send notification to slug_watch socket
+
+    Return False if slug_watch could not be reached or refused the
+    notification, so it has to be left in WATCHDIR, and True otherwise. A
+    notification which was sent but not confirmed in time is not written
+    again, because slug_watch may still apply it after a newer one for the
+    repository."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(SOCKET_TIMEOUT)
+        try:
+            sock.connect(socketpath)
+        except OSError:
+            return False
+        try:
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+            reply = b''
+            while True:
+                data = sock.recv(64)
+                if not data:
+                    break
+                reply += data
+            if reply == b'error\n':
+                return False
+            if reply != b'ok\n':
+                print('slug_watch has not confirmed the notification', file=sys.stderr)
+        except OSError as e:
+            print('slug_watch has not confirmed the notification: {}'.format(e), file=sys.stderr)
+        return True
 
 def run(data):
     WATCHDIR = os.getenv('WATCHDIR')
@@ -13,8 +47,17 @@ def run(data):
     else:
         return
 
+    payload = (os.getenv('GL_USER')+'\n').encode('utf-8')
+    payload += (gitrepo+'\n').encode('utf-8')
+    payload += ''.join(data).encode('utf-8')
+
+    # the socket is optional, WATCHDIR is used when slug_watch does not
+    # listen on it or does not confirm the notification
+    SLUG_SOCKET = os.getenv('SLUG_SOCKET')
+    if SLUG_SOCKET is not None:
+        if send(os.path.join(os.path.expanduser('~'), SLUG_SOCKET), payload):
+            return
+
     (tfile, name) = tempfile.mkstemp(prefix=gitrepo+'.', dir=WATCHDIR)
-    os.write(tfile,(os.getenv('GL_USER')+'\n').encode('utf-8'))
-    os.write(tfile,(gitrepo+'\n').encode('utf-8'))
-    os.write(tfile,''.join(data).encode('utf-8'))
+    os.write(tfile, payload)
     os.close(tfile)
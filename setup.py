@@ -21,6 +21,6 @@ setup(name='git-core-slug',
       classifiers=['Programming Language :: Python :: 3'],
       packages=['git_slug', 'Daemon'],
       data_files=[('adc/bin', ['adc/trash', 'adc/move'])],
-      scripts=['slug.py', 'slug_watch'],
+      scripts=['slug.py', 'slug_watch', 'slug_specs'],
       cmdclass={"install_data": post_install}
      )
@@ -1,23 +1,38 @@
 #!/usr/bin/python3
 
+import asyncio
+import collections
 import copy
+import fnmatch
 import glob
+import hashlib
 import sys
 import os
 import shutil
 import subprocess
+import tempfile
+import time
 import queue
 import multiprocessing
 import argparse
 
-import signal
 import configparser
 
-from multiprocessing import Pool as WorkerPool
-
 from git_slug.gitconst import GITLOGIN, GITSERVER, GIT_REPO, GIT_REPO_PUSH, REMOTE_NAME, REMOTEREFS
 from git_slug.gitrepo import GitRepo, GitRepoError
-from git_slug.refsdata import GitArchiveRefsData, NoMatchedRepos, RemoteRefsError
+from git_slug.history import FetchHistory
+from git_slug.objectstore import ObjectStore
+from git_slug.stats import Stats
+from git_slug.refsdata import GitArchiveRefsData, GitJournalRefsData, GitMirrorRefsData, LocalRefsData, NoMatchedRepos, RemoteRefsError, SharedRefsData
+
+REFSMIRROR = '.Refs.git'
+SYNCSTATE = '.slug-state'
+REFSCACHE = '.slug-heads'
+REFSCACHE_AGE = 60
+FETCHHISTORY = '.slug-history'
+HEAVY_BYTES = 32 * 1024 * 1024
+# default MaxSessions of sshd, more sessions over one connection are refused
+SSH_SESSIONS = 10
 
 class UnquoteConfig(configparser.ConfigParser):
     def get(self, section, option, **kwargs):
@@ -42,23 +57,53 @@ def cpu_count():
         pass
     return 4
 
-def pool_worker_init():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-def run_worker(function, options, args):
-    ret = []
-    pool = WorkerPool(options.jobs, pool_worker_init)
+def run_worker(function, options, args, heavy=None):
+    """Run coroutine function for every tuple in args
+
+    At most options.jobs calls run at the same time, in the order of args.
+    If heavy is given, the tuples for which it returns true are started
+    first, but no more than options.heavyjobs of them run at once. Return
+    list of true results in the order of args."""
+    async def worker(light, heavyqueue, running, ret):
+        start = time.monotonic()
+        busy = 0.0
+        while True:
+            taskstart = time.monotonic()
+            if heavyqueue and running[0] < heavyjobs:
+                (i, arg) = heavyqueue.popleft()
+                running[0] += 1
+                try:
+                    ret[i] = await function(*arg)
+                finally:
+                    running[0] -= 1
+            elif light:
+                (i, arg) = light.popleft()
+                ret[i] = await function(*arg)
+            else:
+                break
+            busy += time.monotonic() - taskstart
+        options.stats.worker(function.__name__, busy, time.monotonic() - start)
+
+    async def run_all(args):
+        ret = [None] * len(args)
+        light = collections.deque()
+        heavyqueue = collections.deque()
+        for (i, arg) in enumerate(args):
+            if heavy is not None and heavy(*arg):
+                heavyqueue.append((i, arg))
+            else:
+                light.append((i, arg))
+        running = [0]
+        await asyncio.gather(*(worker(light, heavyqueue, running, ret) for _ in range(max(1, options.jobs))))
+        return ret
+
+    heavyjobs = getattr(options, 'heavyjobs', None) or max(1, options.jobs // 4)
     try:
-        ret = pool.starmap(function, args)
-        pool.close()
-        pool.join()
-        ret = list(filter(None, ret))
+        ret = asyncio.run(run_all(list(args)))
     except KeyboardInterrupt:
         print('Keyboard interrupt received, finishing...', file=sys.stderr)
-        pool.terminate()
-        pool.join()
         sys.exit(1)
-    return ret
+    return list(filter(None, ret))
 
 def readconfig(path):
     config = UnquoteConfig(delimiters='=', interpolation=None, strict=False)
@@ -69,52 +114,118 @@ def readconfig(path):
         raise SystemExit("I have problems parsing {} file.\n\
 Check if it is consistent with your locale settings.".format(path))
     optionslist = {}
-    for option in ('newpkgs', 'prune'):
+    for option in ('newpkgs', 'prune', 'incremental', 'journal'):
         if config.has_option('PLD', option):
             optionslist[option] = config.getboolean('PLD', option)
-    for option in ('depth', 'repopattern', 'packagesdir'):
+    for option in ('depth', 'repopattern', 'packagesdir', 'filter', 'objectstore', 'refscache'):
         if config.has_option('PLD', option):
             optionslist[option] = config.get('PLD', option)
     if config.has_option('PLD','branch'):
         optionslist['branch'] = config.get('PLD', 'branch').split()
-    for option in ('jobs'):
+    if config.has_option('PLD','sparse'):
+        optionslist['sparse'] = config.get('PLD', 'sparse').split()
+    for option in ('jobs', 'heavyjobs', 'refscacheage'):
         if config.has_option('PLD', option):
             optionslist[option] = config.getint('PLD', option)
 
-    for pathopt in ('packagesdir'):
+    for pathopt in ('packagesdir',):
         if pathopt in optionslist:
             optionslist[pathopt] = os.path.expanduser(optionslist[pathopt])
     return optionslist
 
-def initpackage(name, options):
+object_store = None
+
+def getobjectstore(options):
+    """Return ObjectStore given by options or None if it is not used"""
+    global object_store
+    if object_store is None and getattr(options, 'objectstore', None):
+        objectstore = os.path.join(options.packagesdir, os.path.expanduser(options.objectstore))
+        object_store = ObjectStore(os.path.abspath(objectstore))
+    return object_store
+
+async def initpackage(name, options):
     repo = GitRepo(os.path.join(options.packagesdir, name))
     remotepush = os.path.join(GIT_REPO_PUSH, name)
-    repo.init(os.path.join(GIT_REPO, name), remotepush)
+    store = getobjectstore(options)
+    await repo.ainit(os.path.join(GIT_REPO, name), remotepush,
+            filterspec=getattr(options, 'filter', None), sparse=getattr(options, 'sparse', None),
+            packfetches=store is not None)
+    if store is not None:
+        store.addalternate(repo)
     return repo
 
-def createpackage(name, options):
-    subprocess.Popen(['ssh', GITLOGIN + GITSERVER, 'create', name]).wait()
-    initpackage(name, options)
+async def createpackage(name, options, sshoptions):
+    proc = await asyncio.create_subprocess_exec('ssh', *sshoptions, GITLOGIN + GITSERVER, 'create', name)
+    if await proc.wait():
+        print('Problem with creating {} on {}'.format(name, GITSERVER), file=sys.stderr)
+        return
+    await initpackage(name, options)
 
 def create_packages(options):
-    for package in options.packages:
-        createpackage(package, options)
-
-def getrefs(*args):
+    """Create packages on the server through one shared SSH connection"""
+    with tempfile.TemporaryDirectory(prefix='slug-ssh-') as controldir:
+        sshoptions = ['-o', 'ControlPath=' + os.path.join(controldir, 'master')]
+        master = subprocess.call(['ssh', '-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-f', '-N']
+                + sshoptions + [GITLOGIN + GITSERVER])
+        if master:
+            # open a separate connection for every package
+            sshoptions = []
+            workeroptions = options
+        else:
+            workeroptions = argparse.Namespace(**vars(options))
+            workeroptions.jobs = min(options.jobs, SSH_SESSIONS)
+        try:
+            run_worker(createpackage, workeroptions, [(name, options, sshoptions) for name in options.packages])
+        finally:
+            if not master:
+                subprocess.call(['ssh', '-q', '-O', 'exit'] + sshoptions + [GITLOGIN + GITSERVER],
+                        stderr=subprocess.DEVNULL)
+
+refs_snapshot = None
+
+def getsnapshot(options):
+    """Return data of all remote refs, downloaded only once per process"""
+    global refs_snapshot
+    if refs_snapshot is None:
+        try:
+            with options.stats.phase('refs'):
+                if getattr(options, 'incremental', False):
+                    refs_snapshot = GitMirrorRefsData(os.path.join(options.packagesdir, REFSMIRROR), ('*',))
+                elif getattr(options, 'journal', False):
+                    try:
+                        refs_snapshot = GitJournalRefsData(os.path.join(options.packagesdir, REFSCACHE), ('*',))
+                    except RemoteRefsError:
+                        # Refs repository without journal
+                        refs_snapshot = GitArchiveRefsData(('*',))
+                    options.stats.count('refs_archive_bytes', refs_snapshot.archivesize)
+                elif getattr(options, 'refscache', None):
+                    refs_snapshot = SharedRefsData(os.path.expanduser(options.refscache), ('*',),
+                            maxage=getattr(options, 'refscacheage', REFSCACHE_AGE))
+                    options.stats.count('refs_archive_bytes', refs_snapshot.archivesize)
+                else:
+                    refs_snapshot = GitArchiveRefsData(('*',))
+                    options.stats.count('refs_archive_bytes', refs_snapshot.archivesize)
+        except RemoteRefsError as e:
+            print('Problem with file {} in repository {}'.format(*e.args), file=sys.stderr)
+            sys.exit(1)
+        except NoMatchedRepos:
+            print('No matching package has been found', file=sys.stderr)
+            sys.exit(2)
+    return refs_snapshot
+
+def getrefs(options, pattern, dirpattern=('*',)):
     try:
-        refs = GitArchiveRefsData(*args)
-    except RemoteRefsError as e:
-        print('Problem with file {} in repository {}'.format(*e.args), file=sys.stderr)
-        sys.exit(1)
+        refs = getsnapshot(options).select(pattern, dirpattern)
     except NoMatchedRepos:
         print('No matching package has been found', file=sys.stderr)
         sys.exit(2)
     return refs
 
-def fetch_package(gitrepo, refs_heads, options):
+async def fetch_package(gitrepo, refs_heads, options, history=None):
     ref2fetch = []
+    localrefs = gitrepo.check_remotes(refs_heads)
     for ref in refs_heads:
-        if gitrepo.check_remote(ref) != refs_heads[ref]:
+        if localrefs[ref] != refs_heads[ref]:
             ref2fetch.append('+{}:{}/{}'.format(ref, REMOTEREFS, ref[len('refs/heads/'):]))
     if ref2fetch:
         ref2fetch.append('refs/notes/*:refs/notes/*')
@@ -122,114 +233,319 @@ def fetch_package(gitrepo, refs_heads, options):
         return
 
     try:
-        (stdout, stderr) = gitrepo.fetch(ref2fetch, options.depth)
+        start = time.monotonic()
+        packsize = gitrepo.packsize()
+        (stdout, stderr) = await gitrepo.afetch(ref2fetch, options.depth, filterspec=getattr(options, 'filter', None))
+        duration = time.monotonic() - start
+        size = max(0, gitrepo.packsize() - packsize)
+        store = getobjectstore(options)
+        if store is not None:
+            store.deposit(gitrepo)
+        options.stats.repo(os.path.basename(gitrepo.wtree), 'fetch', duration, size)
+        options.stats.count('repos_fetched')
+        if history is not None:
+            history.record(os.path.basename(gitrepo.wtree), duration, size)
         if stderr != b'':
             print('------', gitrepo.gdir[:-len('.git')], '------\n' + stderr.decode('utf-8'))
             return gitrepo
     except GitRepoError as e:
         print('------', gitrepo.gdir[:-len('.git')], '------\n', e)
          
-def fetch_packages(options, return_all=False):
-    refs = getrefs(options.branch, options.repopattern)
+def synckey(options):
+    patterns = '\0'.join(options.branch) + '\n' + '\0'.join(options.repopattern)
+    return hashlib.sha1(patterns.encode('utf-8')).hexdigest()
+
+async def sync_package(gitrepo, refs_heads, options, isnew, checkrefs, after, history):
+    """Initialize and fetch one repository and pass it on to after"""
+    if isnew:
+        start = time.monotonic()
+        await initpackage(os.path.basename(gitrepo.wtree), options)
+        options.stats.repo(os.path.basename(gitrepo.wtree), 'init', time.monotonic() - start)
+    updated = None
+    if checkrefs:
+        updated = await fetch_package(gitrepo, refs_heads, options, history)
+    if after is not None:
+        await after(gitrepo, updated, options)
+    return updated
+
+def fetch_packages(options, after=None):
+    """Fetch repositories matching options and run coroutine after on them
+
+    Every repository goes through initialization, fetch and after on its
+    own, without waiting for the other repositories to finish the previous
+    step. Repositories which took longest to fetch in the previous runs are
+    started first."""
+    refs = getrefs(options, options.branch, options.repopattern)
+    with options.stats.phase('state'):
+        state = LocalRefsData(os.path.join(options.packagesdir, SYNCSTATE))
+        history = FetchHistory(os.path.join(options.packagesdir, FETCHHISTORY))
+        changed = None
+        if getattr(options, 'incremental', False) and not options.verify:
+            snapshot = getsnapshot(options)
+            changed = snapshot.changed_repos(snapshot.synced(synckey(options)))
     print('Read remotes data')
-    pkgs_new = []
-    if options.newpkgs:
-        for pkgdir in sorted(refs.heads):
-            gitdir = os.path.join(options.packagesdir, pkgdir, '.git')
-            if not os.path.isdir(gitdir):
-                pkgs_new.append(pkgdir)
-
-        run_worker(initpackage, options, zip(pkgs_new, [options] * len(pkgs_new)))
 
     args = []
-    for pkgdir in sorted(refs.heads):
-        if options.omitexisting and pkgdir not in pkgs_new:
+    with options.stats.phase('compare'):
+        for pkgdir in sorted(refs.heads):
+            isnew = options.newpkgs and not os.path.isdir(os.path.join(options.packagesdir, pkgdir, '.git'))
+            if options.omitexisting and not isnew:
+                continue
+            checkrefs = isnew or not (changed is not None and pkgdir not in changed or
+                    not options.verify and state.uptodate(pkgdir, refs.heads[pkgdir]))
+            options.stats.count('repos_checked' if checkrefs else 'repos_skipped')
+            if checkrefs or after is not None:
+                gitrepo = GitRepo(os.path.join(options.packagesdir, pkgdir))
+                args.append((gitrepo, refs.heads[pkgdir], options, isnew, checkrefs, after, history))
+
+    def expected(gitrepo, refs_heads, options, isnew, checkrefs, *rest):
+        return history.duration(os.path.basename(gitrepo.wtree)) if checkrefs else 0.0
+
+    def heavy(gitrepo, refs_heads, options, isnew, checkrefs, *rest):
+        return checkrefs and history.size(os.path.basename(gitrepo.wtree)) >= HEAVY_BYTES
+
+    args.sort(key=lambda arg: expected(*arg), reverse=True)
+    with options.stats.phase('sync'):
+        updated_repos = run_worker(sync_package, options, args, heavy)
+
+    synced = True
+    for (gitrepo, refs_heads, _, _, checkrefs, _, _) in args:
+        if not checkrefs:
             continue
-        else:
-            gitrepo = GitRepo(os.path.join(options.packagesdir, pkgdir))
-            args.append((gitrepo, refs.heads[pkgdir], options))
-
-    updated_repos = run_worker(fetch_package, options, args)
+        pkgdir = os.path.basename(gitrepo.wtree)
+        if not os.path.isdir(gitrepo.gdir):
+            state.remove(pkgdir)
+            continue
+        localrefs = gitrepo.check_remotes(refs_heads)
+        state.update(pkgdir, localrefs)
+        if any(localrefs[ref] != refs_heads[ref] for ref in refs_heads):
+            synced = False
+    if getattr(options, 'incremental', False) and synced:
+        getsnapshot(options).mark_synced(synckey(options))
 
     if options.prune:
-        refs = getrefs('*')
+        refs = getsnapshot(options)
         for pattern in options.repopattern:
             for fulldir in glob.iglob(os.path.join(options.packagesdir, pattern)):
                 pkgdir = os.path.basename(fulldir)
                 if len(refs.heads[pkgdir]) == 0 and os.path.isdir(os.path.join(fulldir, '.git')):
                     print('Removing', fulldir)
                     shutil.rmtree(fulldir)
-    if return_all:
-        return refs.heads
-    else:
-        return updated_repos
-
-def checkout_package(repo, options):
+                    state.remove(pkgdir)
+    if args or options.prune:
+        state.save()
+        history.save()
+    return updated_repos
+
+def checkedout(repo, name):
+    """Tell if checking out name in repo would not change its HEAD"""
+    (ref, sha1) = repo.resolve(name)
+    if ref is None:
+        return False
+    (branch, headsha1) = repo.head()
+    if ref.startswith('refs/heads/'):
+        return branch == ref
+    return branch is None and headsha1 == sha1
+
+async def checkout_package(repo, updated, options):
+    if checkedout(repo, options.checkout):
+        options.stats.count('checkout_skipped')
+        return
     try:
-        repo.checkout(options.checkout)
+        start = time.monotonic()
+        await repo.acheckout(options.checkout)
+        options.stats.repo(os.path.basename(repo.wtree), 'checkout', time.monotonic() - start)
     except GitRepoError as e:
         print('Problem with checking branch {} in repo {}: {}'.format(options.checkout, repo.gdir, e), file=sys.stderr)
 
 def checkout_packages(options):
     if options.checkout is None:
         options.checkout = "/".join([REMOTE_NAME, options.branch[0]])
-    fetch_packages(options)
-    refs = getrefs(options.branch, options.repopattern)
-    repos = []
-    for pkgdir in sorted(refs.heads):
-        repos.append(GitRepo(os.path.join(options.packagesdir, pkgdir)))
-
-    run_worker(checkout_package, options, zip(repos, [options] * len(repos)))
+    fetch_packages(options, checkout_package)
 
-def clone_package(repo, options):
+async def clone_package(repo, updated, options):
+    if updated is None:
+        return
     try:
-        repo.checkout('master')
+        start = time.monotonic()
+        await repo.acheckout('master')
+        options.stats.repo(os.path.basename(repo.wtree), 'checkout', time.monotonic() - start)
     except GitRepoError as e:
         print('Problem with checking branch master in repo {}: {}'.format(repo.gdir, e), file=sys.stderr)
 
 def clone_packages(options):
-    repos = fetch_packages(options)
-    run_worker(clone_package, options, zip(repos, [options] * len(repos)))
+    fetch_packages(options, clone_package)
 
-def pull_package(gitrepo, options):
+async def pull_package(gitrepo, updated, options):
+    if updated is None and not (options.updateall and os.path.isdir(gitrepo.gdir)):
+        return
     directory = os.path.basename(gitrepo.wtree)
     try:
-        (out, err) = gitrepo.commandexc(['rev-parse', '-q', '--verify', '@{u}'])
-        sha1 = out.decode().strip()
-        (out, err) = gitrepo.commandexc(['rebase', sha1])
+        start = time.monotonic()
+        (out, err) = await gitrepo.acommandexc(['rev-list', '--left-right', '--count', 'HEAD...@{u}'])
+        (ahead, behind) = (int(count) for count in out.split())
+        if not behind:
+            options.stats.count('pull_uptodate')
+            return
+        if not ahead:
+            # nothing to rebase, merge refreshes the index, updates the
+            # working tree and moves the branch in one process
+            await gitrepo.acommandexc(['merge', '--ff-only', '-q', '@{u}'])
+            options.stats.repo(directory, 'pull', time.monotonic() - start)
+            options.stats.count('pull_fastforward')
+            print(directory, ":", "Fast-forwarded by {} commits".format(behind))
+            return
+        (out, err) = await gitrepo.acommandexc(['rebase', '@{u}'])
+        options.stats.repo(directory, 'pull', time.monotonic() - start)
+        options.stats.count('pull_rebased')
         for line in out.decode().splitlines():
             print(directory,":",line)
     except GitRepoError as e:
+        options.stats.count('pull_failed')
         for line in e.args[0].splitlines():
             print("{}: {}".format(directory,line))
         pass
 
 def pull_packages(options):
-    repolist = []
-    if options.updateall:
-        pkgs = fetch_packages(options, True)
-        for directory in sorted(os.listdir(options.packagesdir)):
-            if directory in pkgs:
-                repolist.append(GitRepo(os.path.join(options.packagesdir, directory)))
-    else:
-        repolist = fetch_packages(options, False)
-    print('--------Pulling------------')
-    pool = WorkerPool(options.jobs, pool_worker_init)
-    run_worker(pull_package, options, zip(repolist, [options] * len(repolist)))
+    fetch_packages(options, pull_package)
+    counters = options.stats.counters
+    print('Fast-forwarded: {}, rebased: {}, up to date: {}, failed: {}'.format(
+        *(counters.get(name, 0) for name in ('pull_fastforward', 'pull_rebased', 'pull_uptodate', 'pull_failed'))))
+
+def localrepos(options):
+    """Yield (name, GitRepo) of local repositories matching options.repopattern"""
+    for pkgdir in sorted(os.listdir(options.packagesdir)):
+        if not any(fnmatch.fnmatchcase(pkgdir, pattern) for pattern in options.repopattern):
+            continue
+        gitrepo = GitRepo(os.path.join(options.packagesdir, pkgdir))
+        if os.path.isdir(gitrepo.gdir):
+            yield (pkgdir, gitrepo)
+
+def objectcounts(out):
+    """Return dict of values printed by git count-objects -v"""
+    return dict((key, int(value)) for (key, value) in
+            (line.split(': ', 1) for line in out.decode('utf-8').splitlines()) if value.isdigit())
+
+def objectsize(counts):
+    """Return disk usage of loose and packed objects from objectcounts"""
+    return (counts['size'] + counts['size-pack']) * 1024
+
+def dedup_packages(options):
+    """Move objects of local repositories into the shared object store
+
+    Repositories are repacked one by one without objects which are already
+    in the store and the new packs are moved there."""
+    store = getobjectstore(options)
+    if store is None:
+        print('Object store is not defined, use --objectstore option', file=sys.stderr)
+        sys.exit(1)
+    saved = 0
+    for (pkgdir, gitrepo) in localrepos(options):
+        start = time.monotonic()
+        try:
+            size = objectsize(objectcounts(gitrepo.commandexc(['count-objects', '-v'])[0]))
+            store.attach(gitrepo)
+            gitrepo.commandexc(['repack', '-a', '-d', '-l', '-q'])
+            moved = store.deposit(gitrepo)
+            saved += size - moved - objectsize(objectcounts(gitrepo.commandexc(['count-objects', '-v'])[0]))
+        except GitRepoError as e:
+            print('Problem with deduplicating {}: {}'.format(pkgdir, e), file=sys.stderr)
+            continue
+        options.stats.repo(pkgdir, 'dedup', time.monotonic() - start, moved)
+    print('Saved {} bytes'.format(saved))
+
+def looserefs(gitrepo):
+    """Return number of refs stored in separate files"""
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(gitrepo.gdir, 'refs')):
+        count += len(filenames)
+    return count
+
+def stalecommitgraph(gitrepo):
+    """Tell if commit-graph file is missing or older than some pack"""
+    try:
+        graphtime = os.stat(os.path.join(gitrepo.gdir, 'objects', 'info', 'commit-graph')).st_mtime
+    except OSError:
+        graphtime = None
+    packs = glob.glob(os.path.join(gitrepo.gdir, 'objects', 'pack', '*.pack'))
+    if not packs:
+        return False
+    return graphtime is None or max(os.stat(pack).st_mtime for pack in packs) > graphtime
+
+async def maintain_package(pkgdir, gitrepo, options):
+    """Run maintenance tasks which repository gitrepo needs
+
+    Return (pkgdir, saved bytes) if any task has been run."""
+    try:
+        start = time.monotonic()
+        counts = objectcounts((await gitrepo.acommandexc(['count-objects', '-v']))[0])
+        tasks = []
+        if counts['count'] > options.looseobjects or counts['packs'] > options.maxpacks:
+            tasks.append(['gc', '--quiet'])
+        elif looserefs(gitrepo) > options.looserefs:
+            tasks.append(['pack-refs', '--all', '--prune'])
+        for task in tasks:
+            await gitrepo.acommandexc(task)
+            options.stats.count('maintain_' + task[0].replace('-', '_'))
+        # gc writes commit-graph itself, unless it is disabled by gc.writeCommitGraph
+        if stalecommitgraph(gitrepo):
+            task = ['commit-graph', 'write', '--reachable']
+            await gitrepo.acommandexc(task)
+            options.stats.count('maintain_commit_graph')
+            tasks.append(task)
+        if not tasks:
+            return
+        store = getobjectstore(options)
+        moved = store.deposit(gitrepo) if store is not None else 0
+        saved = objectsize(counts) - moved - objectsize(objectcounts((await gitrepo.acommandexc(['count-objects', '-v']))[0]))
+        options.stats.repo(pkgdir, 'maintain', time.monotonic() - start, saved)
+        return (pkgdir, saved)
+    except GitRepoError as e:
+        print('Problem with maintenance of {}: {}'.format(pkgdir, e), file=sys.stderr)
+
+def maintain_packages(options):
+    """Run gc, pack-refs and commit-graph in local repositories which need them"""
+    start = time.monotonic()
+    args = [(pkgdir, gitrepo, options) for (pkgdir, gitrepo) in localrepos(options)]
+    maintained = run_worker(maintain_package, options, args)
+    print('Maintained {} of {} repositories in {:.1f}s, saved {} bytes'.format(len(maintained), len(args),
+        time.monotonic() - start, sum(saved for (pkgdir, saved) in maintained)))
 
 def list_packages(options):
-    refs = getrefs(options.branch, options.repopattern)
+    refs = getrefs(options, options.branch, options.repopattern)
     for package in sorted(refs.heads):
         print(package)
 
 common_options = argparse.ArgumentParser(add_help=False)
 common_options.add_argument('-d', '--packagesdir', help='local directory with git repositories',
     default=os.path.expanduser('~/rpm/packages'))
+common_options.add_argument('--refscache', help='share downloaded heads of remote repositories with other users in DIR',
+    metavar='DIR', default=argparse.SUPPRESS)
+common_options.add_argument('--refscache-age', help='use heads from --refscache without asking the server for SECONDS (default: 60)',
+    dest='refscacheage', metavar='SECONDS', type=int, default=argparse.SUPPRESS)
+common_options.add_argument('--objectstore', help='share objects of repositories in bare repository DIR, relative to packagesdir',
+    metavar='DIR', default=argparse.SUPPRESS)
 
 common_fetchoptions = argparse.ArgumentParser(add_help=False, parents=[common_options])
 common_fetchoptions.add_argument('-j', '--jobs', help='number of threads to use', default=cpu_count(), type=int)
 common_fetchoptions.add_argument('repopattern', nargs='*', default = ['*'])
+common_fetchoptions.add_argument('--stats', help='write timing data of the run to FILE (CSV if FILE ends with .csv, JSON otherwise)',
+        dest='statsfile', metavar='FILE', default=None)
+common_fetchoptions.add_argument('--profile', help='print timing summary of the run',
+        action='store_true', default=False)
+common_fetchoptions.add_argument('--heavy-jobs', help='maximal number of large repositories fetched at once',
+        dest='heavyjobs', default=argparse.SUPPRESS, type=int)
 common_fetchoptions.add_argument('--depth', help='depth of fetch', default=0)
+common_fetchoptions.add_argument('--filter', help='make partial clones, fetching objects according to FILTER (e.g. blob:none or tree:0)',
+        metavar='FILTER', default=argparse.SUPPRESS)
+common_fetchoptions.add_argument('--sparse', help='checkout only files matching PATTERN in new repositories',
+        action='append', metavar='PATTERN', default=argparse.SUPPRESS)
+common_fetchoptions.add_argument('--verify', help='check all local repositories and rebuild the sync-state file',
+        action='store_true', default=False)
+common_fetchoptions.add_argument('--incremental', help='keep a local mirror of Refs repository and check only changed packages',
+        action='store_true', default=argparse.SUPPRESS)
+common_fetchoptions.add_argument('--journal', help='keep a local copy of heads file and download only the journal of changes',
+        action='store_true', default=argparse.SUPPRESS)
 
 default_options = {}
 parser = argparse.ArgumentParser(description='PLD tool for interaction with git repos',
@@ -251,6 +567,7 @@ default_options['update'] = {'omitexisting': False}
 
 init = subparsers.add_parser('init', help='init new repository', parents=[common_options],
         formatter_class=argparse.RawDescriptionHelpFormatter)
+init.add_argument('-j', '--jobs', help='number of threads to use', default=cpu_count(), type=int)
 init.add_argument('packages', nargs='+', help='list of packages to create')
 init.set_defaults(func=create_packages)
 default_options['init'] = {}
@@ -285,7 +602,26 @@ checkout.add_argument('-P', '--prune', help='prune git repositories that do no e
 checkout.set_defaults(func=checkout_packages, newpkgs=True, omitexisting=False)
 default_options['checkout'] = {'newpkgs': True, 'omitexisting': False}
 
-listpkgs = subparsers.add_parser('list', help='list repositories',
+dedup = subparsers.add_parser('dedup', help='move objects of existing repositories to the shared object store',
+        parents=[common_options], formatter_class=argparse.RawDescriptionHelpFormatter)
+dedup.add_argument('repopattern', nargs='*', default = ['*'])
+dedup.set_defaults(func=dedup_packages)
+default_options['dedup'] = {}
+
+maintain = subparsers.add_parser('maintain', help='run gc, pack-refs and commit-graph where needed',
+        parents=[common_options], formatter_class=argparse.RawDescriptionHelpFormatter)
+maintain.add_argument('-j', '--jobs', help='number of threads to use', default=cpu_count(), type=int)
+maintain.add_argument('--loose-objects', help='run gc in repositories with more than N loose objects',
+        dest='looseobjects', metavar='N', default=256, type=int)
+maintain.add_argument('--max-packs', help='run gc in repositories with more than N packs',
+        dest='maxpacks', metavar='N', default=10, type=int)
+maintain.add_argument('--loose-refs', help='pack refs in repositories with more than N loose refs',
+        dest='looserefs', metavar='N', default=32, type=int)
+maintain.add_argument('repopattern', nargs='*', default = ['*'])
+maintain.set_defaults(func=maintain_packages)
+default_options['maintain'] = {}
+
+listpkgs = subparsers.add_parser('list', help='list repositories', parents=[common_options],
         formatter_class=argparse.RawDescriptionHelpFormatter)
 listpkgs.add_argument('-b', '--branch', help='show packages with given branch', action=DelAppend, default=['*'])
 listpkgs.add_argument('repopattern', nargs='*', default = ['*'])
@@ -296,6 +632,11 @@ options = parser.parse_args()
 if hasattr(options, "func"):
     for key in default_options[options.command]:
         setattr(options, key, default_options[options.command][key])
+    options.stats = Stats()
     options.func(options)
+    if getattr(options, 'statsfile', None):
+        options.stats.write(options.statsfile)
+    if getattr(options, 'profile', False):
+        options.stats.summary(sys.stderr)
 else:
     parser.print_help()